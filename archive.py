@@ -0,0 +1,137 @@
+# archive.py
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_BATCH_SIZE = 1000
+SETTLED_STATUSES = ("completed", "failed", "rejected")
+
+WITHDRAWAL_COLUMNS = "id, user_id, amount, status, wallet, tx_hash, created_at"
+# Join condition matching a hot row (w) to an identical archived copy (a)
+SAME_ROW = " AND ".join(f"a.{column} IS w.{column}" for column in WITHDRAWAL_COLUMNS.split(", "))
+
+class WithdrawalArchiver:
+    """Moves settled withdrawals from the hot table into the attached archive database.
+
+    Lookups go through the all_withdrawals view, so callers see hot and
+    archived rows alike. Pass the BackupManager's lock as lock so rows are
+    never moved between the main and archive snapshots of one backup.
+    """
+
+    def __init__(self, db, after_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, lock=None):
+        self.db = db
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.lock = lock or asyncio.Lock()
+
+    def _settled_filter(self):
+        # Queries alias main.withdrawals as w
+        return (
+            f"w.status IN ({','.join('?' * len(SETTLED_STATUSES))}) AND w.created_at < datetime('now', ?)",
+            (*SETTLED_STATUSES, f"-{self.after_days} days"),
+        )
+
+    def archive_batch(self) -> int:
+        settled, params = self._settled_filter()
+        # Rows whose id is already taken in the archive are not copied again, see delete_archived.
+        # No ORDER BY: sorting would read every settled row on each batch
+        ids = [row[0] for row in self.db.execute_query(
+            f"SELECT id FROM main.withdrawals w WHERE {settled} "
+            "AND NOT EXISTS (SELECT 1 FROM archive.withdrawals a WHERE a.id = w.id) LIMIT ?",
+            (*params, self.batch_size)
+        ).fetchall()]
+        if not ids:
+            return 0
+
+        # Two commits, archive first: in WAL mode a transaction spanning both files is not atomic.
+        # A crash between them leaves the rows in both, which delete_archived cleans up
+        placeholders = ",".join("?" * len(ids))
+        copied = self.db.execute_query(
+            f"INSERT INTO archive.withdrawals ({WITHDRAWAL_COLUMNS}) "
+            f"SELECT {WITHDRAWAL_COLUMNS} FROM main.withdrawals WHERE id IN ({placeholders})",
+            tuple(ids)
+        ).rowcount
+        if copied != len(ids):
+            self.db.conn.rollback()
+            raise RuntimeError(f"Archived {copied} of {len(ids)} withdrawals; rolled back")
+        self.db.commit()
+        return self.delete_archived(ids)
+
+    def delete_archived(self, ids=None) -> int:
+        """Delete settled hot rows that have an identical archived copy.
+
+        With ids (already known to be settled), only those rows are checked,
+        by primary key. Without, every settled hot row is, which finishes
+        batches whose copy committed before a crash. Ids archived with
+        different contents stay in the hot table, see colliding_ids.
+        """
+        if ids is None:
+            settled, params = self._settled_filter()
+        else:
+            settled, params = f"w.id IN ({','.join('?' * len(ids))})", tuple(ids)
+        deleted = self.db.execute_query(
+            "DELETE FROM main.withdrawals WHERE id IN ("
+            f"SELECT w.id FROM main.withdrawals w JOIN archive.withdrawals a ON {SAME_ROW} WHERE {settled})",
+            params
+        ).rowcount
+        self.db.commit()
+        return deleted
+
+    def colliding_ids(self, limit=10):
+        # Settled hot rows that cannot be archived because the archive holds a different row with their id
+        settled, params = self._settled_filter()
+        return [row[0] for row in self.db.execute_query(
+            f"SELECT id FROM main.withdrawals w WHERE {settled} "
+            "AND EXISTS (SELECT 1 FROM archive.withdrawals a WHERE a.id = w.id) "
+            f"AND NOT EXISTS (SELECT 1 FROM archive.withdrawals a WHERE {SAME_ROW}) ORDER BY id LIMIT ?",
+            (*params, limit)
+        ).fetchall()]
+
+    async def archive_settled(self) -> int:
+        async with self.lock:
+            total = self.delete_archived()
+            while True:
+                moved = self.archive_batch()
+                total += moved
+                if moved < self.batch_size:
+                    break
+                # Yield between batches so handlers sharing the connection are not starved
+                await asyncio.sleep(0)
+        if total:
+            logger.info(f"Archived {total} settled withdrawals older than {self.after_days} days")
+        colliding = self.colliding_ids()
+        if colliding:
+            # e.g. the hot database was restored from an older snapshot than the archive
+            logger.warning(
+                f"Withdrawals {', '.join(map(str, colliding))} were not archived: "
+                "the archive already holds different rows with the same ids"
+            )
+        return total
+
+    async def run_forever(self) -> None:
+        while True:
+            try:
+                await self.archive_settled()
+            except Exception as e:
+                logger.error(f"Error archiving withdrawals: {e}", exc_info=True)
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    def get(self, withdrawal_id):
+        return self.db.execute_query(
+            f"SELECT {WITHDRAWAL_COLUMNS} FROM all_withdrawals WHERE id=?", (withdrawal_id,)
+        ).fetchone()
+
+    def for_user(self, user_id, limit=10):
+        return self.db.execute_query(
+            f"SELECT {WITHDRAWAL_COLUMNS} FROM all_withdrawals WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+
+    def by_tx_hash(self, tx_hash):
+        return self.db.execute_query(
+            f"SELECT {WITHDRAWAL_COLUMNS} FROM all_withdrawals WHERE tx_hash=?", (tx_hash,)
+        ).fetchall()
@@ -0,0 +1,234 @@
+# backup.py
+import os
+import sys
+import glob
+import gzip
+import time
+import shutil
+import sqlite3
+import asyncio
+import logging
+from datetime import datetime
+from database import DB_PATH, ARCHIVE_PATH
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))  # Snapshots kept per database
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL_SECONDS", str(24 * 3600)))
+# Pages copied per backup step; the bot's connection is held for one step at a time
+PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "32"))
+STEP_PAUSE = float(os.getenv("BACKUP_STEP_PAUSE", "0.002"))  # Seconds between steps so handlers can use the connection
+TRUNCATE_STEP = 64 * 1024 * 1024  # Bytes freed per step when deleting a scratch copy
+
+# Schema name on the bot's connection -> file name prefix of its snapshots
+SNAPSHOT_PREFIXES = {
+    "main": os.path.splitext(os.path.basename(DB_PATH))[0],
+    "archive": os.path.splitext(os.path.basename(ARCHIVE_PATH))[0],
+}
+REQUIRED_TABLES = {
+    "main": {"users", "withdrawals", "banned_users"},
+    "archive": {"withdrawals"},
+}
+
+def verify_database(path, required_tables=()):
+    # Raise if the database fails PRAGMA integrity_check or is missing expected tables
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        if result != "ok":
+            raise ValueError(f"Integrity check failed for {path}: {result}")
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        missing = set(required_tables) - tables
+        if missing:
+            raise ValueError(f"{path} is missing tables: {', '.join(sorted(missing))}")
+    finally:
+        conn.close()
+
+def _parse_snapshot_name(snapshot_path):
+    # Snapshot names look like <prefix>-YYYYmmdd-HHMMSS.db.gz; returns (schema, timestamp)
+    name = os.path.basename(snapshot_path)
+    if not name.endswith(".db.gz"):
+        return None, None
+    parts = name[:-len(".db.gz")].rsplit("-", 2)
+    if len(parts) != 3:
+        return None, None
+    prefix, date, clock = parts
+    schema = next((s for s, p in SNAPSHOT_PREFIXES.items() if p == prefix), None)
+    return schema, f"{date}-{clock}"
+
+def _snapshot_tables(snapshot_path):
+    schema, _ = _parse_snapshot_name(snapshot_path)
+    return REQUIRED_TABLES.get(schema, ())
+
+def _remove_gradually(path):
+    # Unlinking a multi-GB file frees all its blocks in one filesystem transaction,
+    # which stalls the bot's commit fsyncs; shrink it in steps first
+    size = os.path.getsize(path)
+    while size > 0:
+        size = max(0, size - TRUNCATE_STEP)
+        os.truncate(path, size)
+        time.sleep(STEP_PAUSE)
+    os.remove(path)
+
+def verify_snapshot(snapshot_path):
+    # Decompress to a scratch file (gzip checks its CRC) and run the integrity checks
+    scratch = f"{snapshot_path}.verify"
+    try:
+        with gzip.open(snapshot_path, "rb") as src, open(scratch, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        verify_database(scratch, _snapshot_tables(snapshot_path))
+    finally:
+        if os.path.exists(scratch):
+            os.remove(scratch)
+
+def restore_snapshot(snapshot_path, targets=None):
+    """Restore the main and archive snapshots taken at the same time as snapshot_path.
+
+    Either file of the pair can be given; its sibling with the same timestamp
+    must sit next to it, since restoring only one would mix hot and archived
+    withdrawals from different points in time. targets maps schema name to
+    database path (defaults to DB_PATH and ARCHIVE_PATH). Both snapshots are
+    verified before either database is replaced. The bot must be stopped.
+    The previous files are kept as <target>.pre-restore.
+    """
+    targets = targets or {"main": DB_PATH, "archive": ARCHIVE_PATH}
+    schema, timestamp = _parse_snapshot_name(snapshot_path)
+    if schema is None:
+        raise ValueError(f"{snapshot_path} is not a snapshot written by BackupManager")
+
+    directory = os.path.dirname(snapshot_path)
+    snapshots = {
+        name: os.path.join(directory, f"{prefix}-{timestamp}.db.gz")
+        for name, prefix in SNAPSHOT_PREFIXES.items()
+    }
+    missing = [path for path in snapshots.values() if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Snapshot set {timestamp} is incomplete, missing {', '.join(missing)}")
+
+    for target_path in targets.values():
+        for suffix in ("-journal", "-wal", "-shm"):
+            if os.path.exists(target_path + suffix):
+                raise RuntimeError(f"{target_path}{suffix} exists; stop the bot before restoring")
+
+    staged = {name: f"{targets[name]}.restore" for name in snapshots}
+    try:
+        for name, snapshot in snapshots.items():
+            with gzip.open(snapshot, "rb") as src, open(staged[name], "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            verify_database(staged[name], REQUIRED_TABLES[name])
+    except Exception:
+        for path in staged.values():
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    for name, target_path in targets.items():
+        if os.path.exists(target_path):
+            os.replace(target_path, f"{target_path}.pre-restore")
+        os.replace(staged[name], target_path)
+    logger.info(f"Restored snapshot set {timestamp}: {', '.join(snapshots.values())}")
+
+class BackupManager:
+    """Online, incremental snapshots of the bot's databases.
+
+    Uses SQLite's backup API on the bot's own connection. Writes made through
+    that connection are copied into the running backup instead of restarting
+    it, which is what a second connection would force. The main and archive
+    snapshots are taken one after the other, so lock is held for the whole
+    run; share it with WithdrawalArchiver so no rows move between them.
+    """
+
+    def __init__(self, db, backup_dir=BACKUP_DIR, keep=BACKUP_KEEP, lock=None):
+        self.db = db
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.lock = lock or asyncio.Lock()
+        self.status = {"state": "idle"}
+
+    def _progress(self, status, remaining, total):
+        self.status["pages_total"] = total
+        self.status["pages_done"] = total - remaining
+        time.sleep(STEP_PAUSE)
+
+    def _backup_schema(self, schema, timestamp):
+        prefix = SNAPSHOT_PREFIXES[schema]
+        partial = os.path.join(self.backup_dir, f"{prefix}-{timestamp}.db.partial")
+        snapshot = os.path.join(self.backup_dir, f"{prefix}-{timestamp}.db.gz")
+        self.status["schema"] = schema
+
+        try:
+            target = sqlite3.connect(partial)
+            try:
+                # The partial file is scratch space, verified and compressed right after. Without
+                # these, the last step fsyncs the whole copy while holding the bot's connection.
+                target.execute("PRAGMA journal_mode=OFF")
+                target.execute("PRAGMA synchronous=OFF")
+                self.db.conn.backup(target, pages=PAGES_PER_STEP, progress=self._progress, name=schema)
+            finally:
+                target.close()
+            verify_database(partial, REQUIRED_TABLES[schema])
+
+            with open(partial, "rb") as src, gzip.open(snapshot, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        finally:
+            if os.path.exists(partial):
+                _remove_gradually(partial)
+
+        self._rotate(prefix)
+        return snapshot
+
+    def _rotate(self, prefix):
+        # Timestamps sort lexically, so the oldest snapshots come first
+        snapshots = sorted(glob.glob(os.path.join(self.backup_dir, f"{prefix}-*.db.gz")))
+        for old in snapshots[:-self.keep]:
+            os.remove(old)
+            logger.info(f"Removed old backup {old}")
+
+    def _backup_all(self):
+        os.makedirs(self.backup_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        return [self._backup_schema(schema, timestamp) for schema in SNAPSHOT_PREFIXES]
+
+    async def run_backup(self):
+        if self.status["state"] == "running":
+            return self.status
+        started = time.perf_counter()
+        self.status = {"state": "running", "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        try:
+            async with self.lock:
+                files = await asyncio.to_thread(self._backup_all)
+            self.status.update({
+                "state": "ok",
+                "files": files,
+                "size_bytes": sum(os.path.getsize(f) for f in files),
+            })
+            logger.info(f"Backup completed in {time.perf_counter() - started:.1f}s: {', '.join(files)}")
+        except Exception as e:
+            self.status.update({"state": "failed", "error": str(e)})
+            logger.error(f"Backup failed: {e}", exc_info=True)
+        self.status["duration_seconds"] = time.perf_counter() - started
+        return self.status
+
+    async def run_forever(self) -> None:
+        while True:
+            await asyncio.sleep(BACKUP_INTERVAL)
+            await self.run_backup()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    usage = "Usage: python backup.py verify <snapshot.db.gz> | restore <snapshot.db.gz> [<main.db> <archive.db>]"
+    if len(sys.argv) == 3 and sys.argv[1] == "verify":
+        verify_snapshot(sys.argv[2])
+        print(f"{sys.argv[2]}: ok")
+    elif len(sys.argv) == 3 and sys.argv[1] == "restore":
+        restore_snapshot(sys.argv[2])
+    elif len(sys.argv) == 5 and sys.argv[1] == "restore":
+        restore_snapshot(sys.argv[2], {"main": sys.argv[3], "archive": sys.argv[4]})
+    else:
+        print(usage)
+        sys.exit(1)
@@ -0,0 +1,120 @@
+# bench_backup.py
+"""Handler latency while an online backup of a large database is running.
+
+Builds a throwaway airdrop.db of the requested size in a temp directory,
+then fires a handler-like read/update/commit on the event loop every few
+milliseconds. Latency is measured from each call's scheduled time, so
+event-loop stalls are counted too. It compares a quiet baseline, a backup
+through BackupManager, and (with --compare) a single-step backup run on
+the loop thread. --synchronous sets PRAGMA synchronous on the bot's
+connection, to separate fsync contention from the backup itself.
+
+    python bench_backup.py --size-mb 2048 --compare
+    python bench_backup.py --size-mb 2048 --synchronous OFF
+"""
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import statistics
+from database import Database
+from backup import BackupManager
+
+ROW_PADDING = 200  # Bytes of username padding per row
+ROWS_PER_MB = 1024 * 1024 // (ROW_PADDING + 60)
+
+def build_database(db, size_mb):
+    rows = size_mb * ROWS_PER_MB
+    batch = 100000
+    for start in range(1, rows + 1, batch):
+        db.conn.executemany(
+            "INSERT INTO users (user_id, username, balance, referrals, wallet, referrer_id) VALUES (?, ?, 0, 0, ?, ?)",
+            [
+                (user_id, f"user{user_id}".ljust(ROW_PADDING, "x"), f"0x{user_id:040x}", user_id // 2 or None)
+                for user_id in range(start, min(start + batch, rows + 1))
+            ]
+        )
+        db.commit()
+    return rows
+
+def handler(db, rows):
+    # Same shape as balance/withdraw: point read, balance update, commit
+    user_id = random.randint(1, rows)
+    db.execute_query("SELECT referrals, balance FROM users WHERE user_id=?", (user_id,)).fetchone()
+    db.execute_query("UPDATE users SET balance = balance + 1 WHERE user_id=?", (user_id,))
+    db.commit()
+
+async def measure(db, rows, interval, until):
+    latencies = []
+    loop = asyncio.get_running_loop()
+    scheduled = loop.time()
+    while not until():
+        scheduled += interval
+        await asyncio.sleep(max(0, scheduled - loop.time()))
+        handler(db, rows)
+        latencies.append((loop.time() - scheduled) * 1000)
+    return latencies
+
+def summarize(name, latencies):
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+    print(
+        f"{name:<28} n={len(latencies):<6} p50={statistics.median(latencies):7.2f}ms "
+        f"p95={pick(0.95):7.2f}ms p99={pick(0.99):7.2f}ms max={latencies[-1]:8.2f}ms"
+    )
+
+async def run(args):
+    db = Database()
+    if args.synchronous:
+        db.conn.execute(f"PRAGMA synchronous={args.synchronous}")
+    mode = db.conn.execute("PRAGMA journal_mode").fetchone()[0]
+    synchronous = db.conn.execute("PRAGMA synchronous").fetchone()[0]
+    print(f"journal_mode={mode} synchronous={synchronous}")
+    started = time.perf_counter()
+    rows = build_database(db, args.size_mb)
+    size = os.path.getsize("airdrop.db") / 1024 / 1024
+    print(f"Built {rows} users ({size:.0f} MB) in {time.perf_counter() - started:.1f}s")
+
+    deadline = time.perf_counter() + args.baseline_seconds
+    summarize("baseline", await measure(db, rows, args.interval, lambda: time.perf_counter() > deadline))
+
+    manager = BackupManager(db, backup_dir="backups")
+    backup = asyncio.create_task(manager.run_backup())
+    latencies = await measure(db, rows, args.interval, backup.done)
+    status = await backup
+    summarize("during BackupManager backup", latencies)
+    print(
+        f"  backup {status['state']} in {status['duration_seconds']:.1f}s, "
+        f"{status.get('size_bytes', 0) / 1024 / 1024:.0f} MB compressed"
+    )
+
+    if args.compare:
+        # One-shot copy on the loop thread, i.e. what a naive online copy would do
+        async def blocking_backup():
+            await asyncio.sleep(0.5)
+            target = sqlite3.connect("blocking.db")
+            db.conn.backup(target)
+            target.close()
+        task = asyncio.create_task(blocking_backup())
+        summarize("during single-step backup", await measure(db, rows, args.interval, task.done))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=2048)
+    parser.add_argument("--interval", type=float, default=0.005, help="Seconds between simulated handlers")
+    parser.add_argument("--baseline-seconds", type=float, default=10)
+    parser.add_argument("--compare", action="store_true", help="Also measure a blocking single-step backup")
+    parser.add_argument(
+        "--synchronous", choices=["OFF", "NORMAL", "FULL"],
+        help="PRAGMA synchronous for the bot's connection (default: SQLite's)"
+    )
+    args = parser.parse_args()
+
+    # Database opens airdrop.db relative to the working directory
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        asyncio.run(run(args))
@@ -1,6 +1,10 @@
 import sqlite3
 import logging
 
+DB_PATH = 'airdrop.db'
+ARCHIVE_PATH = 'airdrop_archive.db'  # Settled withdrawals moved out of the hot table
+REFERRAL_MAX_DEPTH = 10  # Deepest downline level tracked in referral_closure
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -8,10 +12,38 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def attach_archive(conn, path=ARCHIVE_PATH):
+    # Attach the archive database and expose hot + archived rows as the all_withdrawals view
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    conn.execute("PRAGMA archive.journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS archive.withdrawals (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            amount REAL,
+            status TEXT,
+            wallet TEXT,
+            tx_hash TEXT,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_withdrawals_user ON withdrawals (user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_withdrawals_tx_hash ON withdrawals (tx_hash)")
+    conn.execute("""
+        CREATE TEMP VIEW IF NOT EXISTS all_withdrawals AS
+        SELECT id, user_id, amount, status, wallet, tx_hash, created_at FROM main.withdrawals
+        UNION ALL
+        SELECT id, user_id, amount, status, wallet, tx_hash, created_at FROM archive.withdrawals
+    """)
+
 class Database:
     def __init__(self):
-        self.conn = sqlite3.connect('airdrop.db')
+        # The backup thread reads through this connection so live writes never restart a backup
+        self.conn = sqlite3.connect(DB_PATH, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row  # Enable row factory for dictionary-like access
+        # WAL lets background readers (fraud scan, backups) run without blocking the bot's commits
+        self.conn.execute("PRAGMA journal_mode=WAL")
         self.cursor = self.conn.cursor()
 
         # Create users table with referrer_id
@@ -22,7 +54,8 @@ class Database:
                 balance REAL DEFAULT 0,
                 referrals INTEGER DEFAULT 0,
                 wallet TEXT,
-                referrer_id INTEGER
+                referrer_id INTEGER,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
 
@@ -35,10 +68,15 @@ class Database:
                 status TEXT,
                 wallet TEXT,
                 tx_hash TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                tx_nonce INTEGER
             )
         """)
 
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals (status, created_at)")
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals (user_id)")
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_withdrawals_tx_hash ON withdrawals (tx_hash)")
+
         # Create banned_users table
         self.execute_query("""
             CREATE TABLE IF NOT EXISTS banned_users (
@@ -46,6 +84,51 @@ class Database:
             )
         """)
 
+        # Referral graph: one row per (ancestor, descendant) pair up to REFERRAL_MAX_DEPTH levels
+        self.execute_query("""
+            CREATE TABLE IF NOT EXISTS referral_closure (
+                ancestor_id INTEGER,
+                descendant_id INTEGER,
+                depth INTEGER,
+                PRIMARY KEY (ancestor_id, descendant_id)
+            )
+        """)
+
+        # Materialized downline size per referrer (all tracked levels)
+        self.execute_query("""
+            CREATE TABLE IF NOT EXISTS referral_downline (
+                user_id INTEGER PRIMARY KEY,
+                size INTEGER DEFAULT 0
+            )
+        """)
+
+        # Materialized direct referral counts per referrer and time bucket
+        self.execute_query("""
+            CREATE TABLE IF NOT EXISTS referral_stats (
+                referrer_id INTEGER,
+                period TEXT,
+                bucket TEXT,
+                count INTEGER DEFAULT 0,
+                PRIMARY KEY (referrer_id, period, bucket)
+            )
+        """)
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_referral_stats_bucket ON referral_stats (period, bucket, count)")
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_users_referrals ON users (referrals)")
+
+        # Sybil/fraud scores written in bulk by fraud_scoring.py
+        self.execute_query("""
+            CREATE TABLE IF NOT EXISTS fraud_scores (
+                user_id INTEGER PRIMARY KEY,
+                score REAL,
+                shared_wallet_users INTEGER,
+                burst_ratio REAL,
+                fanout INTEGER,
+                hours_to_withdrawal REAL,
+                scored_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.execute_query("CREATE INDEX IF NOT EXISTS idx_fraud_scores_score ON fraud_scores (score)")
+
         # Migrate existing users table to add referrer_id if it doesn't exist
         try:
             self.cursor.execute("SELECT referrer_id FROM users LIMIT 1")
@@ -58,6 +141,53 @@ class Database:
                 logger.error(f"Unexpected database error during migration: {e}")
                 raise
 
+        # Migrate existing users table to add joined_at; rows created before this stay NULL
+        try:
+            self.cursor.execute("SELECT joined_at FROM users LIMIT 1")
+        except sqlite3.OperationalError as e:
+            if "no such column: joined_at" in str(e):
+                logger.info("Adding joined_at column to users table")
+                self.execute_query("ALTER TABLE users ADD COLUMN joined_at TIMESTAMP")
+                logger.info("Successfully added joined_at column")
+            else:
+                logger.error(f"Unexpected database error during migration: {e}")
+                raise
+
+        # Migrate existing withdrawals table to add tx_nonce, recorded before a transfer is sent
+        try:
+            self.cursor.execute("SELECT tx_nonce FROM withdrawals LIMIT 1")
+        except sqlite3.OperationalError as e:
+            if "no such column: tx_nonce" in str(e):
+                logger.info("Adding tx_nonce column to withdrawals table")
+                self.execute_query("ALTER TABLE withdrawals ADD COLUMN tx_nonce INTEGER")
+                logger.info("Successfully added tx_nonce column")
+            else:
+                logger.error(f"Unexpected database error during migration: {e}")
+                raise
+
+        # ATTACH must run outside a transaction, so do it before any data is written
+        attach_archive(self.conn)
+
+        # Backfill the referral graph from users.referrer_id on first run
+        if not self.cursor.execute("SELECT 1 FROM referral_closure LIMIT 1").fetchone():
+            logger.info("Backfilling referral_closure from users table")
+            self.execute_query("""
+                INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+                WITH RECURSIVE chain(ancestor_id, descendant_id, depth) AS (
+                    SELECT referrer_id, user_id, 1 FROM users
+                    WHERE referrer_id IS NOT NULL AND referrer_id != user_id
+                    UNION ALL
+                    SELECT u.referrer_id, c.descendant_id, c.depth + 1 FROM chain c
+                    JOIN users u ON u.user_id = c.ancestor_id
+                    WHERE u.referrer_id IS NOT NULL AND u.referrer_id != c.descendant_id AND c.depth < ?
+                )
+                SELECT ancestor_id, descendant_id, MIN(depth) FROM chain GROUP BY ancestor_id, descendant_id
+            """, (REFERRAL_MAX_DEPTH,))
+            self.execute_query("""
+                INSERT OR REPLACE INTO referral_downline (user_id, size)
+                SELECT ancestor_id, COUNT(*) FROM referral_closure GROUP BY ancestor_id
+            """)
+
         self.commit()
 
     def execute_query(self, query, params=()):
@@ -67,5 +197,23 @@ class Database:
     def commit(self):
         self.conn.commit()
 
+    def claim_withdrawal(self, withdrawal_id):
+        # Compare-and-set pending -> processing; only one caller can win the claim
+        self.cursor.execute(
+            "UPDATE withdrawals SET status='processing' WHERE id=? AND status='pending'",
+            (withdrawal_id,)
+        )
+        claimed = self.cursor.rowcount == 1
+        self.commit()
+        return claimed
+
+    def release_withdrawal(self, withdrawal_id):
+        # Hand a claimed withdrawal back to the pending queue; callers only do this when no transfer can be mined for it
+        self.cursor.execute(
+            "UPDATE withdrawals SET status='pending', tx_hash=NULL, tx_nonce=NULL WHERE id=? AND status='processing'",
+            (withdrawal_id,)
+        )
+        self.commit()
+
     def __del__(self):
         self.conn.close()
@@ -0,0 +1,183 @@
+# fraud_scoring.py
+import sqlite3
+import logging
+import time
+from itertools import islice
+import numpy as np
+from database import DB_PATH, ARCHIVE_PATH, attach_archive
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 100000
+WRITE_BATCH_SIZE = 1000  # Rows per write transaction; each one briefly holds the database write lock
+WRITE_PAUSE = 0.005  # Seconds between write batches so the bot's busy-waiting commits get the lock
+BURST_WINDOW = 600  # Seconds between two referred signups that count as a burst
+FAST_WITHDRAWAL_WINDOW = 7 * 24 * 3600  # Withdrawals sooner than this after signup look suspicious
+FANOUT_SATURATION = 200  # Direct referral count that maxes out the fan-out feature
+SHARED_WALLET_SATURATION = 3  # Extra accounts on one wallet that max out the shared-wallet feature
+
+# Feature weights; they sum to 1 so scores stay in [0, 1]
+WEIGHTS = {
+    "shared_wallet": 0.35,
+    "burst": 0.25,
+    "fanout": 0.15,
+    "fast_withdrawal": 0.25,
+}
+
+def _load_columns(conn, query, dtypes):
+    # Stream the query in chunks into one NumPy array per column
+    cursor = conn.execute(query)
+    chunks = [[] for _ in dtypes]
+    while True:
+        rows = cursor.fetchmany(CHUNK_SIZE)
+        if not rows:
+            break
+        for i, column in enumerate(zip(*rows)):
+            chunks[i].append(np.array(column, dtype=dtypes[i]))
+    return [np.concatenate(c) if c else np.empty(0, dtype=d) for c, d in zip(chunks, dtypes)]
+
+def _index_of(user_ids, ids):
+    # Position of each id in the sorted user_ids array, or -1 if absent
+    if len(user_ids) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    idx = np.searchsorted(user_ids, ids)
+    idx_clipped = np.minimum(idx, len(user_ids) - 1)
+    return np.where(user_ids[idx_clipped] == ids, idx_clipped, -1)
+
+def compute_scores(user_ids, referrer_ids, joined_at, user_wallets, w_user_ids, w_wallets, w_created_at):
+    """Vectorized sybil features and scores for every user.
+
+    All inputs are column arrays; user_ids must be sorted ascending. Missing
+    referrers and timestamps are encoded as -1, missing wallets as ''.
+    """
+    n = len(user_ids)
+    ref_idx = _index_of(user_ids, referrer_ids)
+    has_ref = ref_idx >= 0
+
+    # Referral-tree fan-out: direct referrals per user
+    fanout = np.bincount(ref_idx[has_ref], minlength=n)
+
+    # Signup bursts: referred users who joined within BURST_WINDOW of a sibling
+    timed = has_ref & (joined_at >= 0)
+    r = ref_idx[timed]
+    t = joined_at[timed]
+    order = np.lexsort((t, r))
+    r, t = r[order], t[order]
+    burst_pair = (r[1:] == r[:-1]) & (t[1:] - t[:-1] <= BURST_WINDOW)
+    in_burst = np.zeros(len(r), dtype=bool)
+    in_burst[1:] |= burst_pair
+    in_burst[:-1] |= burst_pair
+    burst_ratio = np.bincount(r[in_burst], minlength=n) / np.maximum(np.bincount(r, minlength=n), 1)
+    # A referred user inherits their referrer's burst ratio
+    inherited = np.where(has_ref, burst_ratio[np.maximum(ref_idx, 0)], 0.0)
+    burst_ratio = np.maximum(burst_ratio, inherited)
+
+    # Shared wallets: distinct accounts seen on the same address in users or withdrawals
+    w_idx = _index_of(user_ids, w_user_ids)
+    owners = np.concatenate([np.arange(n)[user_wallets != ""], w_idx[(w_idx >= 0) & (w_wallets != "")]])
+    addresses = np.concatenate([user_wallets[user_wallets != ""], w_wallets[(w_idx >= 0) & (w_wallets != "")]])
+    shared_wallet_users = np.zeros(n, dtype=np.int64)
+    if len(addresses):
+        _, wallet_codes = np.unique(addresses, return_inverse=True)
+        pairs = np.unique(wallet_codes.astype(np.int64) * n + owners)
+        pair_wallets, pair_owners = pairs // n, pairs % n
+        accounts_per_wallet = np.bincount(pair_wallets)
+        np.maximum.at(shared_wallet_users, pair_owners, accounts_per_wallet[pair_wallets])
+
+    # Time from signup to first withdrawal request
+    valid = w_idx >= 0
+    no_withdrawal = np.iinfo(np.int64).max
+    first_withdrawal = np.full(n, no_withdrawal, dtype=np.int64)
+    np.minimum.at(first_withdrawal, w_idx[valid], w_created_at[valid])
+    known = (first_withdrawal != no_withdrawal) & (joined_at >= 0)
+    seconds_to_withdrawal = np.where(known, first_withdrawal - joined_at, -1)
+    hours_to_withdrawal = np.where(known, seconds_to_withdrawal / 3600, np.nan)
+
+    features = {
+        "shared_wallet": np.clip((shared_wallet_users - 1) / SHARED_WALLET_SATURATION, 0, 1),
+        "burst": burst_ratio,
+        "fanout": np.clip(np.log1p(fanout) / np.log1p(FANOUT_SATURATION), 0, 1),
+        "fast_withdrawal": np.where(known, np.clip(1 - seconds_to_withdrawal / FAST_WITHDRAWAL_WINDOW, 0, 1), 0.0),
+    }
+    score = sum(WEIGHTS[name] * value for name, value in features.items())
+
+    return {
+        "score": score,
+        "shared_wallet_users": shared_wallet_users,
+        "burst_ratio": burst_ratio,
+        "fanout": fanout,
+        "hours_to_withdrawal": hours_to_withdrawal,
+    }
+
+def score_users(db_path=DB_PATH, flag_threshold=0.5, archive_path=ARCHIVE_PATH):
+    """Score every user and bulk-write the results into fraud_scores.
+
+    Opens its own connection so it can run in a worker thread next to the bot.
+    The database is in WAL mode, so the long read scan does not block the
+    bot's writers; writes go out in small transactions for the same reason.
+    """
+    started = time.perf_counter()
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        attach_archive(conn, archive_path)
+        user_ids, referrer_ids, joined_at, user_wallets = _load_columns(conn, """
+            SELECT user_id, COALESCE(referrer_id, -1),
+                   COALESCE(CAST(strftime('%s', joined_at) AS INTEGER), -1), COALESCE(LOWER(wallet), '')
+            FROM users ORDER BY user_id
+        """, [np.int64, np.int64, np.int64, str])
+        w_user_ids, w_wallets, w_created_at = _load_columns(conn, """
+            SELECT user_id, COALESCE(LOWER(wallet), ''), COALESCE(CAST(strftime('%s', created_at) AS INTEGER), -1)
+            FROM all_withdrawals WHERE user_id IS NOT NULL
+        """, [np.int64, str, np.int64])
+        loaded = time.perf_counter()
+
+        result = compute_scores(user_ids, referrer_ids, joined_at, user_wallets, w_user_ids, w_wallets, w_created_at)
+        scored = time.perf_counter()
+
+        hours = result["hours_to_withdrawal"]
+        rows = zip(
+            user_ids.tolist(),
+            np.round(result["score"], 4).tolist(),
+            result["shared_wallet_users"].tolist(),
+            np.round(result["burst_ratio"], 4).tolist(),
+            result["fanout"].tolist(),
+            np.where(np.isnan(hours), None, np.round(hours, 2)).tolist(),
+        )
+        # Short write transactions so the bot's commits only ever wait for one small batch
+        while True:
+            batch = list(islice(rows, WRITE_BATCH_SIZE))
+            if not batch:
+                break
+            conn.executemany("""
+                INSERT OR REPLACE INTO fraud_scores
+                    (user_id, score, shared_wallet_users, burst_ratio, fanout, hours_to_withdrawal, scored_at)
+                VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            """, batch)
+            conn.commit()
+            time.sleep(WRITE_PAUSE)
+        finished = time.perf_counter()
+    finally:
+        conn.close()
+
+    summary = {
+        "users": len(user_ids),
+        "withdrawals": len(w_user_ids),
+        "flagged": int((result["score"] >= flag_threshold).sum()),
+        "load_seconds": loaded - started,
+        "score_seconds": scored - loaded,
+        "write_seconds": finished - scored,
+    }
+    logger.info(
+        f"Scored {summary['users']} users in {finished - started:.2f}s "
+        f"(load {summary['load_seconds']:.2f}s, score {summary['score_seconds']:.2f}s, "
+        f"write {summary['write_seconds']:.2f}s); {summary['flagged']} at or above {flag_threshold}"
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    score_users()
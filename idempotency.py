@@ -0,0 +1,26 @@
+# idempotency.py
+from collections import OrderedDict
+
+class CallbackDeduplicator:
+    """Bounded LRU of callback keys that have already been claimed.
+
+    Keys are either a callback query ID or an (action, withdrawal_id) pair.
+    A key that is already present is a duplicate and should be answered
+    without touching the database or the chain.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def claim(self, key) -> bool:
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return False
+        self.entries[key] = None
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return True
+
+    def release(self, key) -> None:
+        self.entries.pop(key, None)
@@ -12,9 +12,17 @@ from telegram.helpers import escape_markdown
 from config import BOT_TOKEN, ADMIN_ID
 from database import Database
 from rate_limiter import RateLimiter
+from idempotency import CallbackDeduplicator
+from update_processor import UserOrderedUpdateProcessor
+from referrals import ReferralGraph
+from fraud_scoring import score_users
+from archive import WithdrawalArchiver
+from backup import BackupManager
 from web3 import Web3
+from web3.exceptions import TransactionNotFound
 from dotenv import load_dotenv
 import os
+import asyncio
 import csv
 import io
 from datetime import datetime
@@ -35,6 +43,11 @@ BOT_PRIVATE_KEY = os.getenv("BOT_PRIVATE_KEY")
 BOT_WALLET_ADDRESS = os.getenv("BOT_WALLET_ADDRESS")
 USDT_CONTRACT_ADDRESS = "0x337610d27c682E347C9cD60BD4b3b107C9d34dDd"  # USDT on BSC testnet
 
+# Concurrent update processing
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+ADMIN_UPDATE_SLOTS = int(os.getenv("ADMIN_UPDATE_SLOTS", "4"))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "1024"))  # Updates running or queued behind their user's lock
+
 # BEP20 Token ABI (minimal for USDT)
 USDT_ABI = [
     {
@@ -60,6 +73,18 @@ class AirdropBot:
     def __init__(self):
         self.db = Database()
         self.rate_limiter = RateLimiter()
+        self.callback_dedup = CallbackDeduplicator()
+        self.withdrawals_in_flight = set()  # Withdrawal IDs an approval or reconcile is working on right now
+        self.nonce_lock = asyncio.Lock()  # Held from nonce lookup until the transfer is sent
+        self.referral_graph = ReferralGraph(self.db)
+        # Archiving and backups share a lock so a backup's two snapshots see the same rows
+        maintenance_lock = asyncio.Lock()
+        self.archiver = WithdrawalArchiver(self.db, lock=maintenance_lock)
+        self.archive_task = None
+        self.backups = BackupManager(self.db, lock=maintenance_lock)
+        self.backup_task = None
+        self.backup_run = None
+        self.fraud_scan_run = None
         self.web3 = Web3(Web3.HTTPProvider(BSC_NODE_URL))
         if not self.web3.is_connected():
             logger.error("Failed to connect to BSC node")
@@ -74,15 +99,31 @@ class AirdropBot:
         self.app = ApplicationBuilder()\
             .token(BOT_TOKEN)\
             .defaults(Defaults(parse_mode='Markdown'))\
+            .concurrent_updates(UserOrderedUpdateProcessor(MAX_CONCURRENT_UPDATES, ADMIN_ID, ADMIN_UPDATE_SLOTS, MAX_PENDING_UPDATES))\
+            .post_init(self._post_init)\
+            .post_stop(self._post_stop)\
             .build()
 
         # Register handlers
         self._register_handlers()
 
+    async def _post_init(self, application) -> None:
+        # Plain asyncio task: application.create_task would make shutdown wait on this loop forever
+        self.archive_task = asyncio.create_task(self.archiver.run_forever())
+        self.backup_task = asyncio.create_task(self.backups.run_forever())
+
+    async def _post_stop(self, application) -> None:
+        for task in (self.archive_task, self.backup_task):
+            if task:
+                task.cancel()
+
     def _register_handlers(self):
         self.app.add_handler(CommandHandler("start", self.start, filters=filters.ChatType.PRIVATE))
         self.app.add_handler(CommandHandler("menu", self.show_menu, filters=filters.ChatType.PRIVATE))
         self.app.add_handler(CommandHandler("wallet", self.set_wallet, filters=filters.ChatType.PRIVATE))
+        self.app.add_handler(CommandHandler("banfraud", self.ban_fraud, filters=filters.ChatType.PRIVATE))
+        self.app.add_handler(CommandHandler("lookup", self.lookup_withdrawals, filters=filters.ChatType.PRIVATE))
+        self.app.add_handler(CommandHandler("backup", self.backup, filters=filters.ChatType.PRIVATE))
         self.app.add_handler(CallbackQueryHandler(self.handle_button))
 
     def _get_main_menu(self, user_id: int) -> InlineKeyboardMarkup:
@@ -90,6 +131,7 @@ class AirdropBot:
             InlineKeyboardButton("💰 Balance", callback_data="balance"),
             InlineKeyboardButton("🪙 Set Wallet", callback_data="set_wallet"),
             InlineKeyboardButton("📤 Withdraw", callback_data="withdraw"),
+            InlineKeyboardButton("🏆 Leaderboard", callback_data="leaderboard"),
         ]
         if user_id == ADMIN_ID:
             buttons.append(InlineKeyboardButton("🛠 Admin Dashboard", callback_data="admin_dashboard"))
@@ -101,7 +143,11 @@ class AirdropBot:
         buttons = [
             InlineKeyboardButton("👥 View Users", callback_data="admin_view_users"),
             InlineKeyboardButton("📬 Manage Withdrawals", callback_data="admin_manage_withdrawals"),
+            InlineKeyboardButton("⏳ Stuck Withdrawals", callback_data="admin_processing_withdrawals"),
             InlineKeyboardButton("📊 Export Users", callback_data="admin_export_users"),
+            InlineKeyboardButton("📑 Export Withdrawals", callback_data="admin_export_withdrawals"),
+            InlineKeyboardButton("🏆 Referral Stats", callback_data="admin_leaderboard"),
+            InlineKeyboardButton("🕵️ Fraud Scan", callback_data="admin_fraud_scan"),
             InlineKeyboardButton("🔨 Ban User", callback_data="ban"),
             InlineKeyboardButton("🔙 Back to Main", callback_data="back_to_main"),
         ]
@@ -186,6 +232,9 @@ class AirdropBot:
                 await query.answer()
             elif callback_data == "withdraw":
                 await self.withdraw(query, context)
+            elif callback_data == "leaderboard":
+                await self.leaderboard(query, context)
+                await query.answer()
             elif callback_data == "ban" and user_id == ADMIN_ID:
                 await query.message.reply_text("🔨 *Usage*: /ban <user_id>")
                 await query.answer()
@@ -216,16 +265,43 @@ class AirdropBot:
                     await query.answer()
                     return
                 withdrawal_id = int(callback_data.split("_")[-1])
+                if not await self._claim_callback(query, "approve", withdrawal_id):
+                    return
                 await self.admin_approve_withdrawal(query, context, withdrawal_id)
+            elif callback_data == "admin_processing_withdrawals" and user_id == ADMIN_ID:
+                await self.admin_processing_withdrawals(query, context)
+                await query.answer()
+            elif callback_data.startswith("admin_reconcile_withdrawal_"):
+                if user_id != ADMIN_ID:
+                    await query.message.reply_text("🚫 Unauthorized access.")
+                    await query.answer()
+                    return
+                withdrawal_id = int(callback_data.split("_")[-1])
+                await query.answer()
+                await self.admin_reconcile_withdrawal(query, context, withdrawal_id)
             elif callback_data.startswith("admin_reject_withdrawal_"):
                 if user_id != ADMIN_ID:
                     await query.message.reply_text("🚫 Unauthorized access.")
                     await query.answer()
                     return
                 withdrawal_id = int(callback_data.split("_")[-1])
+                if not await self._claim_callback(query, "reject", withdrawal_id):
+                    return
                 await self.admin_reject_withdrawal(query, context, withdrawal_id)
             elif callback_data == "admin_export_users" and user_id == ADMIN_ID:
                 await self.admin_export_users(query, context)
+            elif callback_data == "admin_export_withdrawals" and user_id == ADMIN_ID:
+                await self.admin_export_withdrawals(query, context)
+                await query.answer()
+            elif callback_data == "admin_leaderboard" and user_id == ADMIN_ID:
+                await self.admin_leaderboard(query, context)
+                await query.answer()
+            elif callback_data.startswith("admin_referrer_") and user_id == ADMIN_ID:
+                await self.admin_referrer_detail(query, context, int(callback_data.split("_")[-1]))
+                await query.answer()
+            elif callback_data == "admin_fraud_scan" and user_id == ADMIN_ID:
+                await self.admin_fraud_scan(query, context)
+                await query.answer()
             elif callback_data == "back_to_main":
                 reply_markup = self._get_main_menu(user_id)
                 await query.message.reply_text("📋 *Main Menu*\nChoose an option:", reply_markup=reply_markup)
@@ -241,6 +317,14 @@ class AirdropBot:
             await query.message.reply_text("❌ An error occurred. Please try again later.")
             await query.answer()
 
+    async def _claim_callback(self, query: Update, action: str, withdrawal_id: int) -> bool:
+        # Drop repeated deliveries and double-clicks before any DB or chain work
+        if not self.callback_dedup.claim(query.id) or not self.callback_dedup.claim((action, withdrawal_id)):
+            logger.info(f"Ignoring duplicate {action} callback for withdrawal ID {withdrawal_id}")
+            await query.answer("⏳ This request is already being processed.")
+            return False
+        return True
+
     async def _check_ban(self, user_id: int) -> bool:
         return bool(self.db.execute_query("SELECT 1 FROM banned_users WHERE user_id=?", (user_id,)).fetchone())
 
@@ -264,17 +348,22 @@ class AirdropBot:
                 ref_id = int(context.args[0])
                 if ref_id != user_id and not await self._check_ban(ref_id):
                     referrer_id = ref_id
-                    self.db.execute_query(
-                        "UPDATE users SET referrals = referrals + 1, balance = balance + ? WHERE user_id=?",
-                        (referral_bonus, ref_id)
-                    )
-                    logger.info(f"Referral bonus of ${referral_bonus} credited to referrer {ref_id} for user {user_id}")
 
-            # Insert or update user with referrer_id
-            self.db.execute_query(
-                "INSERT OR IGNORE INTO users (user_id, username, balance, referrals, referrer_id) VALUES (?, ?, 0, 0, ?)",
+            # Insert user with referrer_id; existing users keep their original referrer
+            is_new_user = self.db.execute_query(
+                "INSERT OR IGNORE INTO users (user_id, username, balance, referrals, referrer_id, joined_at) VALUES (?, ?, 0, 0, ?, CURRENT_TIMESTAMP)",
                 (user_id, username, referrer_id)
-            )
+            ).rowcount == 1
+
+            # Only a newly registered user earns their referrer a bonus
+            if referrer_id and is_new_user:
+                credited = self.db.execute_query(
+                    "UPDATE users SET referrals = referrals + 1, balance = balance + ? WHERE user_id=?",
+                    (referral_bonus, referrer_id)
+                ).rowcount == 1
+                if credited:
+                    self.referral_graph.record_referral(referrer_id, user_id)
+                    logger.info(f"Referral bonus of ${referral_bonus} credited to referrer {referrer_id} for user {user_id}")
             self.db.commit()
 
             bot_username = (await context.bot.get_me()).username
@@ -343,6 +432,43 @@ class AirdropBot:
             logger.error(f"Error in set_wallet command: {e}")
             await update.message.reply_text("❌ An error occurred. Please try again later.")
 
+    def _format_leaderboard(self, entries, downlines=None) -> str:
+        if not entries:
+            return "_No referrals yet._\n"
+        user_ids = [user_id for user_id, _ in entries]
+        placeholders = ",".join("?" * len(user_ids))
+        usernames = dict(self.db.execute_query(
+            f"SELECT user_id, username FROM users WHERE user_id IN ({placeholders})", tuple(user_ids)
+        ).fetchall())
+
+        lines = []
+        for rank, (user_id, count) in enumerate(entries, start=1):
+            username = usernames.get(user_id)
+            name = f"@{escape_markdown(username)}" if username and username != "N/A" else f"User {user_id}"
+            line = f"{rank}. {name} — {count}"
+            if downlines is not None:
+                line += f" (downline {downlines.get(user_id, 0)})"
+            lines.append(line)
+        return "\n".join(lines) + "\n"
+
+    async def leaderboard(self, query: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            user_id = query.from_user.id
+            if await self._check_ban(user_id):
+                await query.message.reply_text("🚫 You are banned from using this bot.")
+                return
+
+            message = (
+                "🏆 *Top Referrers This Week*\n\n"
+                + self._format_leaderboard(self.referral_graph.top_referrers("week", 10))
+                + "\n🌟 *All-Time Top Referrers*\n\n"
+                + self._format_leaderboard(self.referral_graph.top_referrers("all", 10))
+            )
+            await query.message.reply_text(message)
+        except Exception as e:
+            logger.error(f"Error in leaderboard: {e}")
+            await query.message.reply_text("❌ An error occurred. Please try again later.")
+
     async def withdraw(self, query: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         try:
             user_id = query.from_user.id
@@ -371,7 +497,7 @@ class AirdropBot:
                 return
 
             if self.db.execute_query(
-                "SELECT 1 FROM withdrawals WHERE user_id=? AND status='pending'", (user_id,)
+                "SELECT 1 FROM withdrawals WHERE user_id=? AND status IN ('pending', 'processing')", (user_id,)
             ).fetchone():
                 await query.message.reply_text("⏳ You already have a pending withdrawal.")
                 return
@@ -391,6 +517,11 @@ class AirdropBot:
 
             logger.info(f"Withdrawal request submitted by user {user_id}: Amount=${balance:.2f}, Wallet={wallet}, Withdrawal ID={withdrawal_id}")
 
+            fraud_score = self.db.execute_query(
+                "SELECT score FROM fraud_scores WHERE user_id=?", (user_id,)
+            ).fetchone()
+            fraud_display = f"{fraud_score[0]:.2f}" if fraud_score else "Not scored"
+
             await query.message.reply_text("✅ *Withdrawal request submitted for admin approval.*")
             # Send notification to admin with Approve and Reject buttons
             reply_markup = self._get_withdrawal_action_keyboard(withdrawal_id)
@@ -400,7 +531,8 @@ class AirdropBot:
                 f"🆔 *Withdrawal ID*: {withdrawal_id}\n"
                 f"👤 *User*: {user_id}\n"
                 f"💰 *Amount*: ${balance:.2f}\n"
-                f"💼 *Wallet*: `{wallet}`\n\n"
+                f"💼 *Wallet*: `{wallet}`\n"
+                f"🕵️ *Fraud Score*: {fraud_display}\n\n"
                 f"🔧 *Action*:",
                 reply_markup=reply_markup
             )
@@ -459,15 +591,18 @@ class AirdropBot:
             for withdrawal in withdrawals:
                 withdrawal_id, user_id, amount, wallet = withdrawal
                 user_data = self.db.execute_query(
-                    "SELECT username FROM users WHERE user_id=?", (user_id,)
+                    "SELECT u.username, f.score FROM users u LEFT JOIN fraud_scores f ON f.user_id = u.user_id WHERE u.user_id=?",
+                    (user_id,)
                 ).fetchone()
                 username = user_data[0] if user_data and user_data[0] else "N/A"
+                fraud_display = f"{user_data[1]:.2f}" if user_data and user_data[1] is not None else "Not scored"
                 message += (
                     f"🆔 *Withdrawal ID*: {withdrawal_id}\n"
                     f"👤 *User ID*: {user_id}\n"
                     f"📛 *Username*: {username}\n"
                     f"💰 *Amount*: ${amount:.2f}\n"
-                    f"💼 *Wallet*: `{wallet}`\n\n"
+                    f"💼 *Wallet*: `{wallet}`\n"
+                    f"🕵️ *Fraud Score*: {fraud_display}\n\n"
                 )
 
             reply_markup = self._get_withdrawal_list_keyboard(page, withdrawals_per_page)
@@ -477,141 +612,312 @@ class AirdropBot:
             await query.message.reply_text("❌ An error occurred. Please try again later.")
 
     async def admin_approve_withdrawal(self, query: Update, context: ContextTypes.DEFAULT_TYPE, withdrawal_id: int) -> None:
+        marked = False
+        claimed = False
+        tx_sent = False
+        settled = False
         try:
             logger.info(f"Admin attempting to approve withdrawal ID: {withdrawal_id}")
-            withdrawal = self.db.execute_query(
-                "SELECT user_id, amount, wallet FROM withdrawals WHERE id=? AND status='pending'",
-                (withdrawal_id,)
-            ).fetchone()
+            if withdrawal_id in self.withdrawals_in_flight:
+                await query.message.reply_text("⏳ This withdrawal is still being processed. Try again later.")
+                return
+            self.withdrawals_in_flight.add(withdrawal_id)
+            marked = True
 
-            if not withdrawal:
+            claimed = self.db.claim_withdrawal(withdrawal_id)
+            if not claimed:
                 logger.warning(f"Withdrawal ID {withdrawal_id} not found or already processed")
                 await query.message.reply_text("❌ Withdrawal request not found or already processed.")
                 return
 
+            withdrawal = self.db.execute_query(
+                "SELECT user_id, amount, wallet FROM withdrawals WHERE id=? AND status='processing'",
+                (withdrawal_id,)
+            ).fetchone()
+
             user_id, amount, wallet = withdrawal
             usdt_amount = int(amount * 10**6)
             logger.info(f"Processing withdrawal for user {user_id}: Amount=${amount:.2f}, Wallet={wallet}")
 
             # Check bot's USDT balance
-            bot_usdt_balance = self.usdt_contract.functions.balanceOf(self.bot_address).call()
+            bot_usdt_balance = await asyncio.to_thread(self.usdt_contract.functions.balanceOf(self.bot_address).call)
             if bot_usdt_balance < usdt_amount:
                 logger.error(f"Insufficient USDT balance: {bot_usdt_balance / 10**6} USDT for withdrawal ID {withdrawal_id}")
                 await query.message.reply_text("❌ Insufficient USDT in bot wallet.")
+                self._release_withdrawal_claim(withdrawal_id)
                 return
 
             # Check BNB balance for gas
-            bnb_balance = self.web3.eth.get_balance(self.bot_address)
-            gas_price = self.web3.eth.gas_price
+            bnb_balance = await asyncio.to_thread(self.web3.eth.get_balance, self.bot_address)
+            gas_price = await asyncio.to_thread(lambda: self.web3.eth.gas_price)
             gas_limit = 100000
             if bnb_balance < gas_price * gas_limit:
                 logger.error(f"Insufficient BNB: {bnb_balance / 10**18} BNB for withdrawal ID {withdrawal_id}")
                 await query.message.reply_text("❌ Insufficient BNB for gas.")
+                self._release_withdrawal_claim(withdrawal_id)
                 return
 
-            # Build and send transaction
-            user_wallet = Web3.to_checksum_address(wallet)
-            tx = self.usdt_contract.functions.transfer(user_wallet, usdt_amount).build_transaction({
-                'from': self.bot_address,
-                'gas': gas_limit,
-                'gasPrice': gas_price,
-                'nonce': self.web3.eth.get_transaction_count(self.bot_address),
-                'chainId': 97  # BSC testnet
-            })
-
-            logger.info(f"Signing and sending transaction for withdrawal ID {withdrawal_id}")
-            signed_tx = self.web3.eth.account.sign_transaction(tx, private_key=BOT_PRIVATE_KEY)
-            tx_hash = self.web3.eth.send_raw_transaction(signed_tx.raw_transaction)
-            tx_receipt = self.web3.eth.wait_for_transaction_receipt(tx_hash)
-
-            if tx_receipt.status == 1:
-                logger.info(f"Withdrawal ID {withdrawal_id} approved successfully. Tx Hash: {tx_hash.hex()}")
+            # Build and send transaction. Admin approvals run concurrently, so nonce lookup, signing and
+            # sending are serialized; the 'pending' count includes transfers still in the mempool
+            async with self.nonce_lock:
+                user_wallet = Web3.to_checksum_address(wallet)
+                nonce = await asyncio.to_thread(self.web3.eth.get_transaction_count, self.bot_address, 'pending')
+                tx = self.usdt_contract.functions.transfer(user_wallet, usdt_amount).build_transaction({
+                    'from': self.bot_address,
+                    'gas': gas_limit,
+                    'gasPrice': gas_price,
+                    'nonce': nonce,
+                    'chainId': 97  # BSC testnet
+                })
+
+                logger.info(f"Signing and sending transaction for withdrawal ID {withdrawal_id}")
+                signed_tx = self.web3.eth.account.sign_transaction(tx, private_key=BOT_PRIVATE_KEY)
+                tx_hash = signed_tx.hash
+
+                # Record hash and nonce before sending: a send that errors may still have reached the node,
+                # so from here on the row is only settled or released by reconciling against the chain
                 self.db.execute_query(
-                    "UPDATE withdrawals SET status='completed', tx_hash=? WHERE id=?",
-                    (tx_hash.hex(), withdrawal_id)
-                )
-                self.db.execute_query(
-                    "UPDATE users SET balance = balance - ? WHERE user_id=?",
-                    (amount, user_id)
+                    "UPDATE withdrawals SET tx_hash=?, tx_nonce=? WHERE id=? AND status='processing'",
+                    (tx_hash.hex(), nonce, withdrawal_id)
                 )
+                self.db.commit()
+                tx_sent = True
+                await asyncio.to_thread(self.web3.eth.send_raw_transaction, signed_tx.raw_transaction)
 
-                # Check for referrer and credit 5% commission
-                referrer_data = self.db.execute_query(
-                    "SELECT referrer_id FROM users WHERE user_id=?", (user_id,)
-                ).fetchone()
-                if referrer_data and referrer_data[0]:
-                    referrer_id = referrer_data[0]
-                    commission = amount * 0.05  # 5% of withdrawal amount
-                    self.db.execute_query(
-                        "UPDATE users SET balance = balance + ? WHERE user_id=?",
-                        (commission, referrer_id)
-                    )
-                    logger.info(f"Credited ${commission:.2f} (5% commission) to referrer {referrer_id} for user {user_id}'s withdrawal ID {withdrawal_id}")
-                    await context.bot.send_message(
-                        referrer_id,
-                        f"🎉 *Referral Commission Received!*\n"
-                        f"💰 *Amount*: ${commission:.2f} (5% of referred user's withdrawal)\n"
-                        f"👤 *Referred User*: {user_id}\n"
-                        f"🆔 *Withdrawal ID*: {withdrawal_id}"
-                    )
-                    logger.info(f"Sent commission notification to referrer {referrer_id} for Withdrawal ID {withdrawal_id}")
+            tx_receipt = await asyncio.to_thread(self.web3.eth.wait_for_transaction_receipt, tx_hash)
+            succeeded = tx_receipt.status == 1
+            if succeeded:
+                logger.info(f"Withdrawal ID {withdrawal_id} approved successfully. Tx Hash: {tx_hash.hex()}")
+            else:
+                logger.error(f"Transaction failed for withdrawal ID {withdrawal_id}. Tx Hash: {tx_hash.hex()}, Receipt: {tx_receipt}")
 
-                self.db.commit()
+            commission_info = self._settle_withdrawal(withdrawal_id, user_id, amount, tx_hash.hex(), succeeded)
+            settled = True
+            if commission_info is None:
+                await query.message.reply_text("❌ Withdrawal request not found or already processed.")
+                return
 
+            if succeeded:
                 await query.message.reply_text(
                     f"✅ *Withdrawal approved!*\n"
                     f"🆔 Withdrawal ID: {withdrawal_id}\n"
                     f"💰 Amount: ${amount:.2f}\n"
                     f"📤 Tx Hash: `{tx_hash.hex()}`"
                 )
-                await context.bot.send_message(
-                    user_id,
-                    f"✅ *Your USDT withdrawal of ${amount:.2f} has been approved!*\n"
-                    f"📤 Tx Hash: `{tx_hash.hex()}`\n"
-                    f"🔗 Explorer: https://testnet.bscscan.com/tx/{tx_hash.hex()}"
-                )
-                logger.info(f"Sent approval notification to user {user_id} for Withdrawal ID {withdrawal_id}")
             else:
-                logger.error(f"Transaction failed for withdrawal ID {withdrawal_id}. Tx Hash: {tx_hash.hex()}, Receipt: {tx_receipt}")
-                self.db.execute_query(
-                    "UPDATE withdrawals SET status='failed', tx_hash=? WHERE id=?",
-                    (tx_hash.hex(), withdrawal_id)
-                )
-                self.db.commit()
                 await query.message.reply_text("❌ Withdrawal transaction failed.")
-                await context.bot.send_message(
-                    user_id,
-                    f"❌ Your USDT withdrawal of ${amount:.2f} failed. Please contact admin."
-                )
-                logger.info(f"Sent failure notification to user {user_id} for Withdrawal ID {withdrawal_id}")
+            await self._notify_settlement(context, withdrawal_id, user_id, amount, tx_hash.hex(), succeeded, commission_info)
 
             reply_markup = self._get_withdrawal_list_keyboard(1)
             await query.message.reply_text("📬 *Pending Withdrawals*", reply_markup=reply_markup)
         except Exception as e:
             logger.error(f"Error approving withdrawal ID {withdrawal_id}: {str(e)}", exc_info=True)
+            if claimed and not tx_sent:
+                self._release_withdrawal_claim(withdrawal_id)
+            elif tx_sent and not settled:
+                # The transfer may be on chain; reconcile it from Stuck Withdrawals
+                logger.error(f"Withdrawal ID {withdrawal_id} left in 'processing' with transaction {tx_hash.hex()}")
             await query.message.reply_text("❌ An error occurred. Please try again later.")
+        finally:
+            # Without the DB claim (lost, or claim_withdrawal raised) the next click must be allowed through
+            if not claimed:
+                self.callback_dedup.release(("approve", withdrawal_id))
+            # A reconcile may own the marker; only remove it if this call added it
+            if marked:
+                self.withdrawals_in_flight.discard(withdrawal_id)
+
+    def _settle_withdrawal(self, withdrawal_id: int, user_id: int, amount: float, tx_hash: str, succeeded: bool):
+        # Move a 'processing' withdrawal to its final status; returns (referrer_id, commission), or None if already settled
+        status = 'completed' if succeeded else 'failed'
+        if self.db.execute_query(
+            "UPDATE withdrawals SET status=?, tx_hash=? WHERE id=? AND status='processing'",
+            (status, tx_hash, withdrawal_id)
+        ).rowcount != 1:
+            self.db.commit()
+            return None
 
-    async def admin_reject_withdrawal(self, query: Update, context: ContextTypes.DEFAULT_TYPE, withdrawal_id: int) -> None:
+        referrer_id, commission = None, 0
+        if succeeded:
+            self.db.execute_query(
+                "UPDATE users SET balance = balance - ? WHERE user_id=?",
+                (amount, user_id)
+            )
+
+            # Check for referrer and credit 5% commission
+            referrer_data = self.db.execute_query(
+                "SELECT referrer_id FROM users WHERE user_id=?", (user_id,)
+            ).fetchone()
+            if referrer_data and referrer_data[0]:
+                referrer_id = referrer_data[0]
+                commission = amount * 0.05  # 5% of withdrawal amount
+                self.db.execute_query(
+                    "UPDATE users SET balance = balance + ? WHERE user_id=?",
+                    (commission, referrer_id)
+                )
+                logger.info(f"Credited ${commission:.2f} (5% commission) to referrer {referrer_id} for user {user_id}'s withdrawal ID {withdrawal_id}")
+
+        # Commit before awaiting any sends so concurrent handlers never see a half-applied approval
+        self.db.commit()
+        return referrer_id, commission
+
+    async def _notify_settlement(self, context: ContextTypes.DEFAULT_TYPE, withdrawal_id: int, user_id: int,
+                                 amount: float, tx_hash: str, succeeded: bool, commission_info) -> None:
+        referrer_id, commission = commission_info
+        if referrer_id:
+            await context.bot.send_message(
+                referrer_id,
+                f"🎉 *Referral Commission Received!*\n"
+                f"💰 *Amount*: ${commission:.2f} (5% of referred user's withdrawal)\n"
+                f"👤 *Referred User*: {user_id}\n"
+                f"🆔 *Withdrawal ID*: {withdrawal_id}"
+            )
+            logger.info(f"Sent commission notification to referrer {referrer_id} for Withdrawal ID {withdrawal_id}")
+
+        if succeeded:
+            await context.bot.send_message(
+                user_id,
+                f"✅ *Your USDT withdrawal of ${amount:.2f} has been approved!*\n"
+                f"📤 Tx Hash: `{tx_hash}`\n"
+                f"🔗 Explorer: https://testnet.bscscan.com/tx/{tx_hash}"
+            )
+            logger.info(f"Sent approval notification to user {user_id} for Withdrawal ID {withdrawal_id}")
+        else:
+            await context.bot.send_message(
+                user_id,
+                f"❌ Your USDT withdrawal of ${amount:.2f} failed. Please contact admin."
+            )
+            logger.info(f"Sent failure notification to user {user_id} for Withdrawal ID {withdrawal_id}")
+
+    async def admin_processing_withdrawals(self, query: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            withdrawals = self.db.execute_query(
+                "SELECT id, user_id, amount, tx_hash FROM withdrawals WHERE status='processing' ORDER BY id LIMIT 10"
+            ).fetchall()
+
+            back = [InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_dashboard")]
+            if not withdrawals:
+                await query.message.reply_text(
+                    "⏳ *No withdrawals stuck in processing.*", reply_markup=InlineKeyboardMarkup([back])
+                )
+                return
+
+            message = "⏳ *Withdrawals In Processing*\n\n"
+            buttons = []
+            for withdrawal_id, user_id, amount, tx_hash in withdrawals:
+                in_flight = " (approval running)" if withdrawal_id in self.withdrawals_in_flight else ""
+                message += (
+                    f"🆔 *Withdrawal ID*: {withdrawal_id}{in_flight}\n"
+                    f"👤 *User ID*: {user_id}\n"
+                    f"💰 *Amount*: ${amount:.2f}\n"
+                    f"📤 *Tx Hash*: `{tx_hash or 'Not sent'}`\n\n"
+                )
+                buttons.append(InlineKeyboardButton(
+                    f"🔄 Reconcile #{withdrawal_id}", callback_data=f"admin_reconcile_withdrawal_{withdrawal_id}"
+                ))
+            buttons.append(back[0])
+            keyboard = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
+            await query.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+        except Exception as e:
+            logger.error(f"Error in admin_processing_withdrawals: {e}")
+            await query.message.reply_text("❌ An error occurred. Please try again later.")
+
+    async def admin_reconcile_withdrawal(self, query: Update, context: ContextTypes.DEFAULT_TYPE, withdrawal_id: int) -> None:
+        if withdrawal_id in self.withdrawals_in_flight:
+            await query.message.reply_text("⏳ This withdrawal is still being processed. Try again later.")
+            return
+        self.withdrawals_in_flight.add(withdrawal_id)
         try:
-            logger.info(f"Admin attempting to reject withdrawal ID: {withdrawal_id}")
             withdrawal = self.db.execute_query(
-                "SELECT user_id, amount FROM withdrawals WHERE id=? AND status='pending'",
+                "SELECT user_id, amount, tx_hash, tx_nonce FROM withdrawals WHERE id=? AND status='processing'",
                 (withdrawal_id,)
             ).fetchone()
-
             if not withdrawal:
+                await query.message.reply_text("❌ Withdrawal request not found or already processed.")
+                return
+
+            user_id, amount, tx_hash, tx_nonce = withdrawal
+            if not tx_hash:
+                # The approval died before sending anything, so the request can go back to the queue
+                self._release_withdrawal_claim(withdrawal_id)
+                logger.info(f"Reconciled withdrawal ID {withdrawal_id}: no transaction sent, returned to pending")
+                await query.message.reply_text(f"↩️ Withdrawal ID {withdrawal_id} had no transaction and is pending again.")
+                return
+
+            # Read the mined nonce before the receipt: if it had already moved past ours and there is
+            # still no receipt, another transaction took the nonce and this one can never be mined
+            mined_nonce = await asyncio.to_thread(self.web3.eth.get_transaction_count, self.bot_address)
+            try:
+                tx_receipt = await asyncio.to_thread(self.web3.eth.get_transaction_receipt, tx_hash)
+            except TransactionNotFound:
+                tx_receipt = None
+            if tx_receipt is None:
+                if tx_nonce is not None and mined_nonce > tx_nonce:
+                    self._release_withdrawal_claim(withdrawal_id)
+                    logger.warning(
+                        f"Reconciled withdrawal ID {withdrawal_id}: transaction {tx_hash} (nonce {tx_nonce}) "
+                        "was dropped or replaced, returned to pending"
+                    )
+                    await query.message.reply_text(
+                        f"↩️ Transaction for withdrawal ID {withdrawal_id} was dropped or replaced on chain.\n"
+                        f"📤 Tx Hash: `{tx_hash}`\nThe withdrawal is pending again."
+                    )
+                    return
+
+                logger.info(f"Reconcile of withdrawal ID {withdrawal_id}: transaction {tx_hash} not mined yet")
+                await query.message.reply_text(
+                    f"⏳ Transaction for withdrawal ID {withdrawal_id} is not mined yet.\n"
+                    f"📤 Tx Hash: `{tx_hash}`\nTry again later."
+                )
+                return
+
+            succeeded = tx_receipt.status == 1
+            commission_info = self._settle_withdrawal(withdrawal_id, user_id, amount, tx_hash, succeeded)
+            if commission_info is None:
+                await query.message.reply_text("❌ Withdrawal request not found or already processed.")
+                return
+            logger.info(f"Reconciled withdrawal ID {withdrawal_id} as {'completed' if succeeded else 'failed'}")
+            await query.message.reply_text(
+                f"{'✅' if succeeded else '❌'} Withdrawal ID {withdrawal_id} reconciled as "
+                f"*{'completed' if succeeded else 'failed'}*.\n📤 Tx Hash: `{tx_hash}`"
+            )
+            await self._notify_settlement(context, withdrawal_id, user_id, amount, tx_hash, succeeded, commission_info)
+        except Exception as e:
+            logger.error(f"Error reconciling withdrawal ID {withdrawal_id}: {str(e)}", exc_info=True)
+            await query.message.reply_text("❌ An error occurred. Please try again later.")
+        finally:
+            self.withdrawals_in_flight.discard(withdrawal_id)
+
+    def _release_withdrawal_claim(self, withdrawal_id: int) -> None:
+        # Nothing was sent or settled, so let the admin retry once the problem is fixed
+        self.db.release_withdrawal(withdrawal_id)
+        self.callback_dedup.release(("approve", withdrawal_id))
+        self.callback_dedup.release(("reject", withdrawal_id))
+
+    async def admin_reject_withdrawal(self, query: Update, context: ContextTypes.DEFAULT_TYPE, withdrawal_id: int) -> None:
+        claimed = False
+        rejected = False
+        try:
+            logger.info(f"Admin attempting to reject withdrawal ID: {withdrawal_id}")
+            claimed = self.db.claim_withdrawal(withdrawal_id)
+            if not claimed:
                 logger.warning(f"Withdrawal ID {withdrawal_id} not found or already processed")
                 await query.message.reply_text("❌ Withdrawal request not found or already processed.")
                 return
 
+            withdrawal = self.db.execute_query(
+                "SELECT user_id, amount FROM withdrawals WHERE id=? AND status='processing'",
+                (withdrawal_id,)
+            ).fetchone()
+
             user_id, amount = withdrawal
             logger.info(f"Rejecting withdrawal for user {user_id}: Amount=${amount:.2f}")
 
             self.db.execute_query(
-                "UPDATE withdrawals SET status='rejected' WHERE id=?",
+                "UPDATE withdrawals SET status='rejected' WHERE id=? AND status='processing'",
                 (withdrawal_id,)
             )
             self.db.commit()
+            rejected = True
             logger.info(f"Withdrawal ID {withdrawal_id} rejected successfully")
 
             await query.message.reply_text(
@@ -629,8 +935,100 @@ class AirdropBot:
             await query.message.reply_text("📬 *Pending Withdrawals*", reply_markup=reply_markup)
         except Exception as e:
             logger.error(f"Error rejecting withdrawal ID {withdrawal_id}: {str(e)}", exc_info=True)
+            # Only hand back a claim this call won; another handler may own the row
+            if claimed and not rejected:
+                self._release_withdrawal_claim(withdrawal_id)
+            await query.message.reply_text("❌ An error occurred. Please try again later.")
+        finally:
+            # Without the DB claim (lost, or claim_withdrawal raised) the next click must be allowed through
+            if not claimed:
+                self.callback_dedup.release(("reject", withdrawal_id))
+
+    async def admin_leaderboard(self, query: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            weekly = self.referral_graph.top_referrers("week", 25)
+            all_time = self.referral_graph.top_referrers("all", 25)
+            downlines = self.referral_graph.downline_sizes(
+                list({user_id for user_id, _ in weekly + all_time})
+            )
+            message = (
+                "🏆 *Referral Stats — This Week*\n\n"
+                + self._format_leaderboard(weekly, downlines)
+                + "\n🌟 *Referral Stats — All Time*\n\n"
+                + self._format_leaderboard(all_time, downlines)
+            )
+            message += "\n🔍 Tap a referrer below for downline levels and history."
+
+            buttons = [
+                InlineKeyboardButton(f"🔍 {referrer_id}", callback_data=f"admin_referrer_{referrer_id}")
+                for referrer_id, _ in weekly[:6]
+            ]
+            buttons.append(InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_dashboard"))
+            keyboard = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
+            await query.message.reply_text(message, reply_markup=InlineKeyboardMarkup(keyboard))
+        except Exception as e:
+            logger.error(f"Error in admin_leaderboard: {e}")
             await query.message.reply_text("❌ An error occurred. Please try again later.")
 
+    async def admin_referrer_detail(self, query: Update, context: ContextTypes.DEFAULT_TYPE, referrer_id: int) -> None:
+        try:
+            levels = self.referral_graph.downline_size(referrer_id, by_level=True)
+            daily = self.referral_graph.referral_history(referrer_id, "day", 14)
+            weekly = self.referral_graph.referral_history(referrer_id, "week", 8)
+
+            message = (
+                f"🔍 *Referrer {referrer_id}*\n"
+                f"👥 *Downline*: {self.referral_graph.downline_size(referrer_id)}\n\n"
+                f"*By Level*:\n"
+            )
+            message += "".join(f"L{depth}: {count}\n" for depth, count in levels) or "_No downline._\n"
+            message += "\n*Referrals per Week*:\n"
+            message += "".join(f"{bucket}: {count}\n" for bucket, count in weekly) or "_None yet._\n"
+            message += "\n*Referrals per Day (last 14)*:\n"
+            message += "".join(f"{bucket}: {count}\n" for bucket, count in daily) or "_None yet._\n"
+
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Referral Stats", callback_data="admin_leaderboard")]])
+            await query.message.reply_text(message, reply_markup=reply_markup)
+        except Exception as e:
+            logger.error(f"Error in admin_referrer_detail: {e}")
+            await query.message.reply_text("❌ An error occurred. Please try again later.")
+
+    async def admin_fraud_scan(self, query: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            if self.fraud_scan_run and not self.fraud_scan_run.done():
+                await query.message.reply_text("⏳ A fraud scan is already running. The results will be sent when it finishes.")
+                return
+
+            # Run in the background so the admin's later updates are not queued behind it
+            self.fraud_scan_run = asyncio.create_task(self._run_fraud_scan_and_report(context))
+            await query.message.reply_text("🕵️ Fraud scan started. The results will be sent when it finishes.")
+        except Exception as e:
+            logger.error(f"Error in admin_fraud_scan: {e}")
+            await query.message.reply_text("❌ An error occurred. Please try again later.")
+
+    async def _run_fraud_scan_and_report(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            # Runs on its own connection in a worker thread so other handlers keep going
+            summary = await asyncio.to_thread(score_users)
+            suspects = self.db.execute_query(
+                "SELECT user_id, score, shared_wallet_users, fanout FROM fraud_scores ORDER BY score DESC LIMIT 10"
+            ).fetchall()
+
+            message = (
+                f"🕵️ *Fraud Scan Complete*\n"
+                f"👥 *Users scored*: {summary['users']}\n"
+                f"🚩 *Flagged (≥ 0.50)*: {summary['flagged']}\n"
+                f"⏱ *Duration*: {summary['load_seconds'] + summary['score_seconds'] + summary['write_seconds']:.1f}s\n\n"
+                f"*Top Suspects*:\n"
+            )
+            for user_id, score, shared_wallet_users, fanout in suspects:
+                message += f"👤 {user_id} — score {score:.2f}, wallet shared by {shared_wallet_users}, referrals {fanout}\n"
+            message += "\n🔨 Ban everyone at or above a score with /banfraud <min\\_score>"
+            await context.bot.send_message(ADMIN_ID, message)
+        except Exception as e:
+            logger.error(f"Fraud scan failed: {e}", exc_info=True)
+            await context.bot.send_message(ADMIN_ID, "❌ Fraud scan failed. Check the logs for details.")
+
     async def admin_export_users(self, query: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         try:
             users = self.db.execute_query(
@@ -664,6 +1062,123 @@ class AirdropBot:
             logger.error(f"Error in admin_export_users: {e}")
             await query.message.reply_text("❌ An error occurred. Please try again later.")
 
+    async def admin_export_withdrawals(self, query: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            # all_withdrawals spans the hot table and the archive
+            withdrawals = self.db.execute_query(
+                "SELECT id, user_id, amount, status, wallet, tx_hash, created_at FROM all_withdrawals ORDER BY id"
+            ).fetchall()
+
+            if not withdrawals:
+                await query.message.reply_text("📬 *No withdrawals to export.*")
+                return
+
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(["Withdrawal ID", "User ID", "Amount (USDT)", "Status", "Wallet Address", "Tx Hash", "Created At"])
+            for withdrawal in withdrawals:
+                writer.writerow([value if value is not None else "" for value in withdrawal])
+
+            csv_data = output.getvalue().encode('utf-8')
+            output.close()
+
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            await query.message.reply_document(
+                document=io.BytesIO(csv_data),
+                filename=f"withdrawals_export_{timestamp}.csv",
+                caption="📑 *Withdrawal Data Export*"
+            )
+        except Exception as e:
+            logger.error(f"Error in admin_export_withdrawals: {e}")
+            await query.message.reply_text("❌ An error occurred. Please try again later.")
+
+    async def lookup_withdrawals(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            if update.effective_user.id != ADMIN_ID:
+                await update.message.reply_text("🚫 Unauthorized access.")
+                return
+
+            usage = "🔎 *Usage*: /lookup id <withdrawal\\_id> | user <user\\_id> | tx <tx\\_hash>"
+            if len(context.args) != 2:
+                await update.message.reply_text(usage)
+                return
+
+            kind, value = context.args[0].lower(), context.args[1].strip()
+            if kind == "id" and value.isdigit():
+                row = self.archiver.get(int(value))
+                withdrawals = [row] if row else []
+            elif kind == "user" and value.isdigit():
+                withdrawals = self.archiver.for_user(int(value))
+            elif kind == "tx":
+                withdrawals = self.archiver.by_tx_hash(value.lower())
+            else:
+                await update.message.reply_text(usage)
+                return
+
+            if not withdrawals:
+                await update.message.reply_text("🔎 *No matching withdrawals found.*")
+                return
+
+            message = "🔎 *Withdrawals*\n\n"
+            for withdrawal_id, user_id, amount, status, wallet, tx_hash, created_at in withdrawals:
+                message += (
+                    f"🆔 *Withdrawal ID*: {withdrawal_id}\n"
+                    f"👤 *User ID*: {user_id}\n"
+                    f"💰 *Amount*: ${amount:.2f}\n"
+                    f"📌 *Status*: {status}\n"
+                    f"💼 *Wallet*: `{wallet}`\n"
+                    f"📤 *Tx Hash*: `{tx_hash or 'N/A'}`\n"
+                    f"🕒 *Created*: {created_at}\n\n"
+                )
+            await update.message.reply_text(message)
+        except Exception as e:
+            logger.error(f"Error in lookup command: {e}")
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+
+    def _format_backup_status(self) -> str:
+        status = self.backups.status
+        state = status["state"]
+        if state == "idle":
+            return "💾 *Backup*: no backup has run since the bot started."
+        message = f"💾 *Backup*: {state}\n🕒 *Started*: {status['started_at']}\n"
+        if state == "running":
+            if status.get("pages_total"):
+                percent = 100 * status["pages_done"] / status["pages_total"]
+                message += f"📦 *Database*: {status['schema']} — {percent:.0f}% ({status['pages_done']}/{status['pages_total']} pages)\n"
+            return message
+        message += f"⏱ *Duration*: {status['duration_seconds']:.1f}s\n"
+        if state == "ok":
+            message += f"📁 *Size*: {status['size_bytes'] / 1024 / 1024:.1f} MB (compressed, integrity verified)\n"
+            message += "".join(f"`{os.path.basename(path)}`\n" for path in status["files"])
+        else:
+            message += f"❌ *Error*: {escape_markdown(status['error'])}\n"
+        return message
+
+    async def _run_backup_and_report(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await self.backups.run_backup()
+        await context.bot.send_message(ADMIN_ID, self._format_backup_status())
+
+    async def backup(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            if update.effective_user.id != ADMIN_ID:
+                await update.message.reply_text("🚫 Unauthorized access.")
+                return
+
+            if context.args and context.args[0].lower() == "status":
+                await update.message.reply_text(self._format_backup_status())
+                return
+
+            if self.backups.status["state"] == "running":
+                await update.message.reply_text("⏳ A backup is already running.\n\n" + self._format_backup_status())
+                return
+
+            # Run in the background so the admin's later updates are not queued behind it
+            self.backup_run = asyncio.create_task(self._run_backup_and_report(context))
+            await update.message.reply_text("💾 Backup started. Check progress with /backup status")
+        except Exception as e:
+            logger.error(f"Error in backup command: {e}")
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+
     async def ban(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         try:
             if update.effective_user.id != ADMIN_ID:
@@ -684,6 +1199,31 @@ class AirdropBot:
             logger.error(f"Error in ban command: {e}")
             await update.message.reply_text("❌ An error occurred. Please try again later.")
 
+    async def ban_fraud(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        try:
+            if update.effective_user.id != ADMIN_ID:
+                await update.message.reply_text("🚫 Unauthorized access.")
+                return
+
+            try:
+                min_score = float(context.args[0]) if context.args else None
+            except ValueError:
+                min_score = None
+            if min_score is None or not 0 < min_score <= 1:
+                await update.message.reply_text("🔨 *Usage*: /banfraud <min\\_score between 0 and 1>")
+                return
+
+            banned = self.db.execute_query(
+                "INSERT OR IGNORE INTO banned_users (user_id) SELECT user_id FROM fraud_scores WHERE score >= ? AND user_id != ?",
+                (min_score, ADMIN_ID)
+            ).rowcount
+            self.db.commit()
+            logger.info(f"Bulk-banned {banned} users with fraud score >= {min_score}")
+            await update.message.reply_text(f"🔨 Banned {banned} users with fraud score ≥ {min_score:.2f}.")
+        except Exception as e:
+            logger.error(f"Error in ban_fraud command: {e}")
+            await update.message.reply_text("❌ An error occurred. Please try again later.")
+
     @staticmethod
     def _is_valid_wallet(wallet: str) -> bool:
         return (
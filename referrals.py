@@ -0,0 +1,143 @@
+# referrals.py
+from datetime import datetime
+from database import REFERRAL_MAX_DEPTH
+
+LEADERBOARD_SIZE = 100
+
+def current_buckets():
+    # Local time, like the rest of the bot
+    now = datetime.now()
+    year, week, _ = now.isocalendar()
+    return {"day": now.strftime("%Y-%m-%d"), "week": f"{year}-W{week:02d}"}
+
+class Leaderboard:
+    """Top-K referrers by score, updated incrementally as scores grow.
+
+    Scores only ever increase, so comparing a new score against the current
+    minimum is enough to keep the top K exact.
+    """
+
+    def __init__(self, size=LEADERBOARD_SIZE):
+        self.size = size
+        self.scores = {}
+        self.ranked = None
+
+    def update(self, user_id, score):
+        if user_id not in self.scores and len(self.scores) >= self.size:
+            lowest = min(self.scores, key=self.scores.get)
+            if score <= self.scores[lowest]:
+                return
+            del self.scores[lowest]
+        self.scores[user_id] = score
+        self.ranked = None
+
+    def top(self, n):
+        if self.ranked is None:
+            self.ranked = sorted(self.scores.items(), key=lambda item: item[1], reverse=True)
+        return self.ranked[:n]
+
+class ReferralGraph:
+    def __init__(self, db, size=LEADERBOARD_SIZE):
+        self.db = db
+        self.size = size
+        self.all_time = Leaderboard(size)
+        for user_id, referrals in self.db.execute_query(
+            "SELECT user_id, referrals FROM users WHERE referrals > 0 ORDER BY referrals DESC LIMIT ?", (size,)
+        ).fetchall():
+            self.all_time.update(user_id, referrals)
+        self.week_bucket = None
+        self.weekly = None
+        self._load_week(current_buckets()["week"])
+
+    def _load_week(self, bucket):
+        self.week_bucket = bucket
+        self.weekly = Leaderboard(self.size)
+        for referrer_id, count in self.db.execute_query(
+            "SELECT referrer_id, count FROM referral_stats WHERE period='week' AND bucket=? ORDER BY count DESC LIMIT ?",
+            (bucket, self.size)
+        ).fetchall():
+            self.weekly.update(referrer_id, count)
+
+    def record_referral(self, referrer_id, user_id):
+        # Caller owns the transaction; users.referrals must already be incremented
+        if referrer_id == user_id:
+            return
+        self.db.execute_query("""
+            INSERT OR IGNORE INTO referral_closure (ancestor_id, descendant_id, depth)
+            SELECT ?, ?, 1
+            UNION ALL
+            SELECT ancestor_id, ?, depth + 1 FROM referral_closure
+            WHERE descendant_id=? AND ancestor_id != ? AND depth < ?
+        """, (referrer_id, user_id, user_id, referrer_id, user_id, REFERRAL_MAX_DEPTH))
+        self.db.execute_query("""
+            INSERT INTO referral_downline (user_id, size)
+            SELECT ancestor_id, 1 FROM referral_closure WHERE descendant_id=?
+            ON CONFLICT(user_id) DO UPDATE SET size = size + 1
+        """, (user_id,))
+
+        buckets = current_buckets()
+        for period, bucket in buckets.items():
+            self.db.execute_query("""
+                INSERT INTO referral_stats (referrer_id, period, bucket, count) VALUES (?, ?, ?, 1)
+                ON CONFLICT(referrer_id, period, bucket) DO UPDATE SET count = count + 1
+            """, (referrer_id, period, bucket))
+
+        if buckets["week"] != self.week_bucket:
+            self._load_week(buckets["week"])
+        else:
+            week_count = self.db.execute_query(
+                "SELECT count FROM referral_stats WHERE referrer_id=? AND period='week' AND bucket=?",
+                (referrer_id, buckets["week"])
+            ).fetchone()[0]
+            self.weekly.update(referrer_id, week_count)
+
+        referrals = self.db.execute_query(
+            "SELECT referrals FROM users WHERE user_id=?", (referrer_id,)
+        ).fetchone()
+        if referrals:
+            self.all_time.update(referrer_id, referrals[0])
+
+    def top_referrers(self, period="week", limit=10):
+        if period == "week":
+            week = current_buckets()["week"]
+            if week != self.week_bucket:
+                self._load_week(week)
+            ranked = self.weekly.top(self.size)
+        else:
+            ranked = self.all_time.top(self.size)
+        if not ranked:
+            return []
+
+        # Banned users keep their counts but never show up; one O(K) lookup per render
+        placeholders = ",".join("?" * len(ranked))
+        banned = {row[0] for row in self.db.execute_query(
+            f"SELECT user_id FROM banned_users WHERE user_id IN ({placeholders})",
+            tuple(user_id for user_id, _ in ranked)
+        ).fetchall()}
+        return [entry for entry in ranked if entry[0] not in banned][:limit]
+
+    def downline_size(self, user_id, by_level=False):
+        if by_level:
+            return self.db.execute_query(
+                "SELECT depth, COUNT(*) FROM referral_closure WHERE ancestor_id=? GROUP BY depth ORDER BY depth",
+                (user_id,)
+            ).fetchall()
+        row = self.db.execute_query(
+            "SELECT size FROM referral_downline WHERE user_id=?", (user_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def downline_sizes(self, user_ids):
+        if not user_ids:
+            return {}
+        placeholders = ",".join("?" * len(user_ids))
+        rows = self.db.execute_query(
+            f"SELECT user_id, size FROM referral_downline WHERE user_id IN ({placeholders})", tuple(user_ids)
+        ).fetchall()
+        return {user_id: size for user_id, size in rows}
+
+    def referral_history(self, referrer_id, period="day", limit=30):
+        return self.db.execute_query(
+            "SELECT bucket, count FROM referral_stats WHERE referrer_id=? AND period=? ORDER BY bucket DESC LIMIT ?",
+            (referrer_id, period, limit)
+        ).fetchall()
@@ -0,0 +1,60 @@
+# update_processor.py
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping each user's updates in order.
+
+    Updates are split into an admin lane and a user lane with their own
+    semaphores, so a backlog of user traffic never delays admin handlers.
+    The two lanes together never run more than max_concurrent_updates handlers.
+    Admin updates are not serialized: approve/reject are guarded by the
+    callback deduplicator and the DB claim, and a duplicate click has to be
+    answered while the first approval is still waiting on the chain.
+
+    The base class semaphore is held by every update from before it waits on
+    its user's lock, so it is sized to max_pending_updates, the number of
+    updates kept in flight, not to the handler limit. Sizing it to the handler
+    limit would let one user's queued updates take every slot.
+    """
+
+    def __init__(self, max_concurrent_updates: int, admin_id: int, admin_slots: int = 1, max_pending_updates: int = 1024):
+        if not 0 < admin_slots < max_concurrent_updates:
+            raise ValueError("admin_slots must be between 1 and max_concurrent_updates - 1")
+        if max_pending_updates < max_concurrent_updates:
+            raise ValueError("max_pending_updates must be at least max_concurrent_updates")
+        super().__init__(max_pending_updates)
+        self.admin_id = admin_id
+        self.admin_lane = asyncio.BoundedSemaphore(admin_slots)
+        self.user_lane = asyncio.BoundedSemaphore(max_concurrent_updates - admin_slots)
+        self.user_locks = {}  # user_id -> [lock, number of updates holding or waiting on it]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user_id = None
+        if isinstance(update, Update) and update.effective_user:
+            user_id = update.effective_user.id
+        lane = self.admin_lane if user_id == self.admin_id else self.user_lane
+
+        if user_id is None or user_id == self.admin_id:
+            async with lane:
+                await coroutine
+            return
+
+        entry = self.user_locks.setdefault(user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters in FIFO order, so a user's updates run in arrival order
+            async with entry[0]:
+                async with lane:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_locks[user_id]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass